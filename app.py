@@ -1,103 +1,307 @@
 import streamlit as st
 import pandas as pd
 import sqlite3
+import threading
 import io # Necesario para manejar la descarga de archivos
+from functools import partial
+import xlsxwriter
+import pyarrow as pa
 
-# --- CONFIGURACIÓN DE LA BASE DE DATOS (Mismos Helpers) ---
-# (Las funciones init_db y run_query permanecen IGUALES que en el código anterior)
+# --- CONSULTAS SQL ---
+# Definidas una sola vez: el mismo texto sobre la misma conexión reutiliza la sentencia
+# ya compilada por SQLite (caché de sentencias de sqlite3).
 
+# Alumnos
+Q_ALUMNOS_LISTADO = "SELECT id AS ID, nombre AS Nombre, edad AS Edad, grado AS Grado FROM alumnos"
+Q_ALUMNOS_OPCIONES = "SELECT id, nombre FROM alumnos ORDER BY nombre"
+Q_ALUMNO_POR_ID = "SELECT * FROM alumnos WHERE id=?"
+Q_INSERT_ALUMNO = "INSERT INTO alumnos (nombre, edad, grado) VALUES (?,?,?)"
+Q_UPDATE_ALUMNO = "UPDATE alumnos SET nombre=?, edad=?, grado=? WHERE id=?"
+Q_DELETE_ALUMNO = "DELETE FROM alumnos WHERE id=?"
+
+# Materias
+Q_MATERIAS_CATALOGO = 'SELECT id AS ID, nombre AS Nombre, descripcion AS "Descripción" FROM materias'
+Q_MATERIAS_OPCIONES = "SELECT id, nombre FROM materias ORDER BY nombre"
+Q_INSERT_MATERIA = "INSERT INTO materias (nombre, descripcion) VALUES (?,?)"
+Q_DELETE_MATERIA = "DELETE FROM materias WHERE nombre=?"
+
+# Asignaciones
+Q_MATERIAS_ASIGNADAS = """
+    SELECT m.id, m.nombre FROM materias m
+    JOIN asignaciones a ON m.id = a.materia_id
+    WHERE a.alumno_id = ?
+"""
+Q_INSERT_ASIGNACION = "INSERT INTO asignaciones (alumno_id, materia_id) VALUES (?,?)"
+Q_DELETE_ASIGNACIONES_ALUMNO = "DELETE FROM asignaciones WHERE alumno_id=?"
+
+# Calificaciones
+Q_INSERT_CALIF = "INSERT INTO calificaciones (alumno_id, materia_id, nota) VALUES (?,?,?)"
+Q_DELETE_CALIF_ALUMNO = "DELETE FROM calificaciones WHERE alumno_id=?"
+# Materias asignadas (Tipo='asignada') y notas (Tipo='nota') del alumno en una sola consulta;
+# incluye notas de materias que ya no tiene asignadas, igual que el historial.
+# Promedio: promedio general de sus notas (AVG ignora los NULL de las filas 'asignada').
+Q_CALIFICACIONES_ALUMNO = """
+    SELECT *, AVG(Nota) OVER () AS Promedio
+    FROM (
+        SELECT 'asignada' AS Tipo, m.id AS MateriaID, m.nombre AS Materia, NULL AS Nota, NULL AS Fecha
+        FROM materias m
+        JOIN asignaciones a ON m.id = a.materia_id
+        WHERE a.alumno_id = ?
+        UNION ALL
+        SELECT 'nota', m.id, m.nombre, c.nota, c.fecha
+        FROM calificaciones c
+        JOIN materias m ON c.materia_id = m.id
+        WHERE c.alumno_id = ?
+    )
+    ORDER BY Fecha DESC
+"""
+
+# Reporte
+Q_REPORTE_DETALLE = """
+    SELECT a.nombre AS Alumno, m.nombre AS Materia, c.nota AS Calificacion, c.fecha AS Fecha
+    FROM calificaciones c
+    JOIN alumnos a ON c.alumno_id = a.id
+    JOIN materias m ON c.materia_id = m.id
+    WHERE c.alumno_id = ?
+    ORDER BY m.nombre, c.fecha DESC
+"""
+Q_REPORTE_RESUMEN = """
+    SELECT a.nombre AS Alumno, m.nombre AS Materia,
+           AVG(c.nota) AS Promedio_Materia, COUNT(c.nota) AS Total_Notas
+    FROM calificaciones c
+    JOIN alumnos a ON c.alumno_id = a.id
+    JOIN materias m ON c.materia_id = m.id
+    WHERE c.alumno_id = ?
+    GROUP BY m.id
+    ORDER BY m.nombre
+"""
+Q_REPORTE_HUELLA = """
+    SELECT (SELECT nombre FROM alumnos WHERE id = ?), COUNT(*), COALESCE(MAX(c.id), 0), COALESCE(MAX(c.fecha), '')
+    FROM calificaciones c
+    JOIN materias m ON c.materia_id = m.id
+    WHERE c.alumno_id = ?
+"""
+
+# --- CONFIGURACIÓN DE LA BASE DE DATOS ---
+# Una sola conexión compartida (get_conn) para no reabrir el archivo en cada consulta.
+# La comparten todas las sesiones (hilos) de Streamlit: cada lectura y cada transacción
+# completa (execute -> commit/rollback) se hace con conn.lock tomado.
+
+class Conexion(sqlite3.Connection):
+    """Conexión SQLite con un lock para no mezclar transacciones de distintas sesiones."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+
+@st.cache_resource
+def get_conn():
+    """Abre una única conexión a la base de datos y la reutiliza entre consultas y re-ejecuciones."""
+    conn = sqlite3.connect('escuela.db', check_same_thread=False, cached_statements=128, factory=Conexion)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA cache_size=-20000')
+    conn.execute('PRAGMA mmap_size=268435456')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    return conn
+
+@st.cache_resource
 def init_db():
-    """Inicializa la base de datos y crea las tablas si no existen."""
-    conn = sqlite3.connect('escuela.db')
-    c = conn.cursor()
+    """Inicializa la base de datos y crea las tablas si no existen (una vez por proceso)."""
+    conn = get_conn()
+    with conn.lock, conn:
+        c = conn.cursor()
     
-    # Tabla Alumnos
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS alumnos (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nombre TEXT NOT NULL,
-            edad INTEGER,
-            grado TEXT
-        )
-    ''')
+        # Tabla Alumnos
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS alumnos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                nombre TEXT NOT NULL,
+                edad INTEGER,
+                grado TEXT
+            )
+        ''')
     
-    # Tabla Materias (Catálogo general)
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS materias (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nombre TEXT NOT NULL,
-            descripcion TEXT
-        )
-    ''')
+        # Tabla Materias (Catálogo general)
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS materias (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                nombre TEXT NOT NULL,
+                descripcion TEXT
+            )
+        ''')
     
-    # Tabla Asignaciones (Materias Maestro - Qué materias ve cada alumno)
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS asignaciones (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            alumno_id INTEGER,
-            materia_id INTEGER,
-            FOREIGN KEY (alumno_id) REFERENCES alumnos (id),
-            FOREIGN KEY (materia_id) REFERENCES materias (id)
-        )
-    ''')
+        # Tabla Asignaciones (Materias Maestro - Qué materias ve cada alumno)
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS asignaciones (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                alumno_id INTEGER,
+                materia_id INTEGER,
+                FOREIGN KEY (alumno_id) REFERENCES alumnos (id),
+                FOREIGN KEY (materia_id) REFERENCES materias (id)
+            )
+        ''')
     
-    # Tabla Calificaciones
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS calificaciones (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            alumno_id INTEGER,
-            materia_id INTEGER,
-            nota REAL,
-            fecha DATE DEFAULT CURRENT_DATE,
-            FOREIGN KEY (alumno_id) REFERENCES alumnos (id),
-            FOREIGN KEY (materia_id) REFERENCES materias (id)
-        )
-    ''')
-    conn.commit()
-    conn.close()
+        # Tabla Calificaciones
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS calificaciones (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                alumno_id INTEGER,
+                materia_id INTEGER,
+                nota REAL,
+                fecha DATE DEFAULT CURRENT_DATE,
+                FOREIGN KEY (alumno_id) REFERENCES alumnos (id),
+                FOREIGN KEY (materia_id) REFERENCES materias (id)
+            )
+        ''')
+
+        # Índices sobre las claves foráneas usadas en filtros y JOINs
+        c.execute('CREATE INDEX IF NOT EXISTS idx_calif_alumno ON calificaciones (alumno_id, materia_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_calif_materia ON calificaciones (materia_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_asig_alumno ON asignaciones (alumno_id, materia_id)')
+
+        # Nombre de materia único (se borra y se selecciona por nombre).
+        # En bases existentes con nombres repetidos, se conserva el primero y a los demás
+        # se les agrega su id, para que cada materia se pueda elegir y borrar por separado.
+        # El nombre nuevo se elige en Python para que nunca choque con uno ya existente.
+        nombres = {nombre for (nombre,) in c.execute('SELECT nombre FROM materias')}
+        repetidas = c.execute('''
+            SELECT id, nombre FROM materias
+            WHERE id NOT IN (SELECT MIN(id) FROM materias GROUP BY nombre)
+        ''').fetchall()
+        for id_mat, nombre in repetidas:
+            nuevo = f"{nombre} ({id_mat})"
+            while nuevo in nombres:
+                nuevo += f" ({id_mat})"
+            nombres.add(nuevo)
+            c.execute('UPDATE materias SET nombre=? WHERE id=?', (nuevo, id_mat))
+        c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_materias_nombre ON materias (nombre)')
+    return True
+
+@st.cache_data(ttl=60)
+def read_query(query, params=()):
+    """Ejecuta una consulta de lectura. El resultado queda en caché hasta la próxima escritura."""
+    conn = get_conn()
+    with conn.lock:
+        return conn.execute(query, params).fetchall()
+
+@st.cache_data(ttl=60)
+def read_df(query, params=(), parse_dates=None):
+    """Igual que read_query, pero construye el DataFrame directamente desde el cursor."""
+    conn = get_conn()
+    with conn.lock:
+        return pd.read_sql_query(query, conn, params=params, parse_dates=parse_dates)
+
+@st.cache_data(ttl=60)
+def read_table(query, params=()):
+    """Igual que read_query, pero devuelve una tabla Arrow que st.dataframe muestra sin pasar por pandas."""
+    conn = get_conn()
+    with conn.lock:
+        c = conn.execute(query, params)
+        columnas = [d[0] for d in c.description]
+        filas = c.fetchall()
+    return pa.table({col: [fila[i] for fila in filas] for i, col in enumerate(columnas)})
+
+def clear_read_cache():
+    """Invalida las lecturas en caché tras una escritura."""
+    read_query.clear()
+    read_df.clear()
+    read_table.clear()
+
+def write_query(query, params=()):
+    """Ejecuta una consulta de escritura e invalida la caché de lecturas."""
+    conn = get_conn()
+    try:
+        with conn.lock, conn:
+            conn.execute(query, params)
+    finally:
+        clear_read_cache()
+    return True
 
 def run_query(query, params=(), return_data=False):
     """Función auxiliar para ejecutar consultas SQL."""
-    conn = sqlite3.connect('escuela.db')
-    c = conn.cursor()
     try:
-        c.execute(query, params)
         if return_data:
-            data = c.fetchall()
-            conn.close()
-            return data
-        conn.commit()
-        conn.close()
+            return read_query(query, params)
+        return write_query(query, params)
+    except Exception as e:
+        st.error(f"Error en base de datos: {e}")
+        return False
+
+def run_tx(statements, many=()):
+    """Ejecuta varias consultas de escritura en una sola transacción.
+
+    statements: [(query, params), ...], cada una con execute.
+    many: [(query, lista_de_params), ...], cada una con executemany, después de statements.
+    """
+    conn = get_conn()
+    try:
+        with conn.lock, conn:
+            for query, params in statements:
+                conn.execute(query, params)
+            for query, seq_of_params in many:
+                conn.executemany(query, seq_of_params)
         return True
     except Exception as e:
         st.error(f"Error en base de datos: {e}")
-        conn.close()
         return False
+    finally:
+        clear_read_cache()
 
 # ---------------- NUEVA FUNCIÓN DE REPORTE ----------------
 
-def generate_report_data(alumno_id):
-    """Obtiene los datos del boletín de calificaciones para un alumno específico."""
-    query = """
-        SELECT a.nombre AS Alumno, m.nombre AS Materia, c.nota AS Calificacion, c.fecha AS Fecha
-        FROM calificaciones c
-        JOIN alumnos a ON c.alumno_id = a.id
-        JOIN materias m ON c.materia_id = m.id
-        WHERE c.alumno_id = ?
-        ORDER BY m.nombre, c.fecha DESC
+def report_fingerprint(alumno_id):
+    """Devuelve (nombre, cantidad de notas, id de la última nota, fecha más reciente) del alumno.
+
+    Consulta barata que solo cambia cuando cambian sus notas o su nombre; se usa como
+    clave de caché del reporte y de los archivos exportados. El id de la última nota
+    (AUTOINCREMENT, nunca se reutiliza) evita que una clave anterior vuelva a aparecer,
+    por ejemplo al borrar una materia y registrar otra nota el mismo día.
+    """
+    return run_query(Q_REPORTE_HUELLA, (alumno_id, alumno_id), return_data=True)[0]
+
+@st.cache_data(max_entries=100)
+def generate_report_data(alumno_id, fingerprint):
+    """Obtiene los datos del boletín de calificaciones para un alumno específico.
+
+    fingerprint (ver report_fingerprint) solo sirve como clave de caché.
     """
-    data = run_query(query, (alumno_id,), return_data=True)
-    if data:
-        df = pd.DataFrame(data, columns=['Alumno', 'Materia', 'Calificacion', 'Fecha'])
-        # Calcular el promedio de las calificaciones para un resumen
-        df_summary = df.groupby(['Alumno', 'Materia']).agg(
-            Promedio_Materia=('Calificacion', 'mean'),
-            Total_Notas=('Calificacion', 'count')
-        ).reset_index()
+    df = read_df(Q_REPORTE_DETALLE, (alumno_id,), parse_dates=['Fecha'])
+    if not df.empty:
+        # Calcular el promedio de las calificaciones para un resumen (agregado en SQL)
+        df_summary = read_df(Q_REPORTE_RESUMEN, (alumno_id,))
         
         return df, df_summary
     return pd.DataFrame(), pd.DataFrame()
 
+def write_sheet(workbook, sheet_name, df):
+    """Escribe un DataFrame en una hoja nueva, fila por fila (compatible con constant_memory)."""
+    worksheet = workbook.add_worksheet(sheet_name)
+    worksheet.write_row(0, 0, df.columns)
+    for i, row in enumerate(df.itertuples(index=False), start=1):
+        worksheet.write_row(i, 0, row)
+
+@st.cache_data(max_entries=100)
+def build_csv(alumno_id, fingerprint):
+    """Genera el CSV con el resumen de promedios del alumno."""
+    _, df_summary = generate_report_data(alumno_id, fingerprint)
+    return df_summary.to_csv(index=False).encode('utf-8')
+
+@st.cache_data(max_entries=20)
+def build_xlsx(alumno_id, fingerprint):
+    """Genera el boletín completo en Excel (resumen + historial) del alumno."""
+    df_all_notes, df_summary = generate_report_data(alumno_id, fingerprint)
+
+    # constant_memory: xlsxwriter vuelca cada fila a disco en cuanto se pasa a la siguiente.
+    # pandas.to_excel escribe columna por columna, así que las hojas se escriben a mano.
+    buffer = io.BytesIO()
+    options = {'constant_memory': True, 'strings_to_numbers': False, 'default_date_format': 'yyyy-mm-dd'}
+    with xlsxwriter.Workbook(buffer, options) as workbook:
+        write_sheet(workbook, 'Resumen', df_summary)
+        write_sheet(workbook, 'Historial Completo', df_all_notes)
+
+    return buffer.getvalue()
+
 
 # --- INTERFAZ DE USUARIO ---
 
@@ -105,7 +309,7 @@ def main():
     st.set_page_config(page_title="Gestión Escolar", layout="wide")
     st.title("📚 Sistema de Gestión Escolar")
     
-    # Inicializar DB
+    # Inicializar DB (solo la primera vez por proceso)
     init_db()
 
     menu = ["Alumnos", "Materias", "Asignar Materias (Maestro)", "Calificaciones"]
@@ -124,23 +328,21 @@ def main():
                 grado = st.text_input("Grado/Curso")
                 submitted = st.form_submit_button("Guardar Alumno")
                 if submitted:
-                    run_query("INSERT INTO alumnos (nombre, edad, grado) VALUES (?,?,?)", (nombre, edad, grado))
+                    run_query(Q_INSERT_ALUMNO, (nombre, edad, grado))
                     st.success(f"Alumno {nombre} guardado.")
 
         with tab2:
-            data = run_query("SELECT * FROM alumnos", return_data=True)
-            df = pd.DataFrame(data, columns=['ID', 'Nombre', 'Edad', 'Grado'])
-            st.dataframe(df, use_container_width=True)
+            st.dataframe(read_table(Q_ALUMNOS_LISTADO), use_container_width=True)
 
         with tab3:
-            data = run_query("SELECT id, nombre FROM alumnos", return_data=True)
+            data = run_query(Q_ALUMNOS_OPCIONES, return_data=True)
             if data:
                 opciones = {f"{id} - {nombre}": id for id, nombre in data}
                 seleccion = st.selectbox("Seleccionar Alumno a Editar/Borrar", list(opciones.keys()))
                 id_sel = opciones.get(seleccion)
                 
                 # Cargar datos actuales
-                datos_actuales = run_query("SELECT * FROM alumnos WHERE id=?", (id_sel,), return_data=True)[0]
+                datos_actuales = run_query(Q_ALUMNO_POR_ID, (id_sel,), return_data=True)[0]
                 
                 with st.form("edit_alumno"):
                     col1, col2 = st.columns(2)
@@ -153,17 +355,19 @@ def main():
                     delete = c2.form_submit_button("Borrar Alumno", type="primary")
                     
                     if update:
-                        run_query("UPDATE alumnos SET nombre=?, edad=?, grado=? WHERE id=?", (new_nombre, new_edad, new_grado, id_sel))
+                        run_query(Q_UPDATE_ALUMNO, (new_nombre, new_edad, new_grado, id_sel))
                         st.success("Datos actualizados.")
                         st.rerun()
                     
                     if delete:
-                        run_query("DELETE FROM alumnos WHERE id=?", (id_sel,))
                         # También borrar sus asignaciones y notas para mantener integridad
-                        run_query("DELETE FROM asignaciones WHERE alumno_id=?", (id_sel,))
-                        run_query("DELETE FROM calificaciones WHERE alumno_id=?", (id_sel,))
-                        st.warning("Alumno eliminado.")
-                        st.rerun()
+                        if run_tx([
+                            (Q_DELETE_ALUMNO, (id_sel,)),
+                            (Q_DELETE_ASIGNACIONES_ALUMNO, (id_sel,)),
+                            (Q_DELETE_CALIF_ALUMNO, (id_sel,)),
+                        ]):
+                            st.warning("Alumno eliminado.")
+                            st.rerun()
             else:
                 st.info("No hay alumnos registrados para editar o borrar.")
 
@@ -180,22 +384,20 @@ def main():
                 nombre_mat = st.text_input("Nombre Materia")
                 desc_mat = st.text_area("Descripción")
                 if st.form_submit_button("Crear Materia"):
-                    run_query("INSERT INTO materias (nombre, descripcion) VALUES (?,?)", (nombre_mat, desc_mat))
-                    st.success("Materia creada.")
-                    st.rerun()
+                    # El catálogo (columna derecha) se dibuja después: ya incluye la nueva materia
+                    if run_query(Q_INSERT_MATERIA, (nombre_mat, desc_mat)):
+                        st.success("Materia creada.")
 
         with c2:
             st.subheader("Catálogo de Materias")
-            data = run_query("SELECT * FROM materias", return_data=True)
-            df_mat = pd.DataFrame(data, columns=['ID', 'Nombre', 'Descripción'])
-            st.dataframe(df_mat, use_container_width=True)
+            tabla_mat = read_table(Q_MATERIAS_CATALOGO)
+            st.dataframe(tabla_mat, use_container_width=True)
             
             # Sección simple para borrar materias
-            if not df_mat.empty:
-                del_materia = st.selectbox("Borrar Materia", df_mat['Nombre'].tolist())
+            if tabla_mat.num_rows:
+                del_materia = st.selectbox("Borrar Materia", tabla_mat.column('Nombre').to_pylist())
                 if st.button("Eliminar Materia"):
-                    id_mat = df_mat[df_mat['Nombre'] == del_materia]['ID'].values[0]
-                    run_query("DELETE FROM materias WHERE id=?", (int(id_mat),))
+                    run_query(Q_DELETE_MATERIA, (del_materia,))
                     st.rerun()
 
     # ---------------- MÓDULO ASIGNACIÓN (MATERIAS MAESTRO) (No cambia) ----------------
@@ -204,9 +406,9 @@ def main():
         st.info("Aquí defines el 'Plan de Estudios' individual de cada alumno.")
 
         # Obtener alumnos
-        alumnos = run_query("SELECT id, nombre FROM alumnos", return_data=True)
+        alumnos = run_query(Q_ALUMNOS_OPCIONES, return_data=True)
         # Obtener materias
-        materias = run_query("SELECT id, nombre FROM materias", return_data=True)
+        materias = run_query(Q_MATERIAS_OPCIONES, return_data=True)
 
         if alumnos and materias:
             dict_alumnos = {nombre: id for id, nombre in alumnos}
@@ -216,12 +418,8 @@ def main():
             id_alumno = dict_alumnos[alumno_sel]
 
             # Ver asignaciones actuales
-            asignadas_raw = run_query("""
-                SELECT m.nombre FROM materias m 
-                JOIN asignaciones a ON m.id = a.materia_id 
-                WHERE a.alumno_id = ?
-            """, (id_alumno,), return_data=True)
-            asignadas_actuales = [x[0] for x in asignadas_raw]
+            asignadas_raw = run_query(Q_MATERIAS_ASIGNADAS, (id_alumno,), return_data=True)
+            asignadas_actuales = [x[1] for x in asignadas_raw]
 
             st.write(f"Materias actualmente asignadas a **{alumno_sel}**:")
             
@@ -234,13 +432,12 @@ def main():
 
             if st.button("Guardar Asignaciones"):
                 # Estrategia: Borrar todo lo anterior de este alumno y re-insertar lo seleccionado
-                run_query("DELETE FROM asignaciones WHERE alumno_id=?", (id_alumno,))
-                
-                for materia_nombre in nuevas_asignaciones:
-                    id_mat = dict_materias[materia_nombre]
-                    run_query("INSERT INTO asignaciones (alumno_id, materia_id) VALUES (?,?)", (id_alumno, id_mat))
-                
-                st.success(f"Plan de estudios actualizado para {alumno_sel}.")
+                # (todo en una sola transacción)
+                if run_tx(
+                    [(Q_DELETE_ASIGNACIONES_ALUMNO, (id_alumno,))],
+                    many=[(Q_INSERT_ASIGNACION, [(id_alumno, dict_materias[m]) for m in nuevas_asignaciones])],
+                ):
+                    st.success(f"Plan de estudios actualizado para {alumno_sel}.")
         else:
             st.warning("Necesitas registrar alumnos y materias primero.")
 
@@ -248,7 +445,7 @@ def main():
     elif choice == "Calificaciones":
         st.header("Registro y Reporte de Notas")
         
-        alumnos = run_query("SELECT id, nombre FROM alumnos", return_data=True)
+        alumnos = run_query(Q_ALUMNOS_OPCIONES, return_data=True)
         
         if alumnos:
             dict_alumnos = {nombre: id for id, nombre in alumnos}
@@ -260,15 +457,14 @@ def main():
                 alumno_calif = st.selectbox("Calificar a:", list(dict_alumnos.keys()))
                 id_alumno_calif = dict_alumnos[alumno_calif]
                 
-                # Solo mostrar materias asignadas a este alumno
-                materias_asignadas = run_query("""
-                    SELECT m.id, m.nombre FROM materias m 
-                    JOIN asignaciones a ON m.id = a.materia_id 
-                    WHERE a.alumno_id = ?
-                """, (id_alumno_calif,), return_data=True)
+                # Materias asignadas e historial de notas en una sola consulta
+                df_calif = read_df(Q_CALIFICACIONES_ALUMNO, (id_alumno_calif, id_alumno_calif), parse_dates=['Fecha'])
+                es_asignada = df_calif['Tipo'] == 'asignada'
+                materias_asignadas = df_calif[es_asignada]
                 
-                if materias_asignadas:
-                    dict_mat_asig = {nombre: id for id, nombre in materias_asignadas}
+                # Solo mostrar materias asignadas a este alumno
+                if not materias_asignadas.empty:
+                    dict_mat_asig = dict(zip(materias_asignadas['Materia'].tolist(), materias_asignadas['MateriaID'].tolist()))
                     
                     c1, c2, c3 = st.columns(3)
                     materia_calif = c1.selectbox("Materia", list(dict_mat_asig.keys()))
@@ -276,28 +472,22 @@ def main():
                     
                     if c3.button("Guardar Nota"):
                         id_mat_calif = dict_mat_asig[materia_calif]
-                        run_query("INSERT INTO calificaciones (alumno_id, materia_id, nota) VALUES (?,?,?)", 
-                                  (id_alumno_calif, id_mat_calif, nota))
-                        st.success("Nota registrada.")
-                        st.rerun() # Refrescar para ver la nota en la tabla
+                        if run_query(Q_INSERT_CALIF, (id_alumno_calif, id_mat_calif, nota)):
+                            st.success("Nota registrada.")
+                            # Releer solo esta consulta para que el historial incluya la nota nueva
+                            df_calif = read_df(Q_CALIFICACIONES_ALUMNO, (id_alumno_calif, id_alumno_calif), parse_dates=['Fecha'])
+                            es_asignada = df_calif['Tipo'] == 'asignada'
                     
                     st.divider()
                     st.subheader(f"Historial de Notas de {alumno_calif}")
                     
                     # Mostrar historial de notas
-                    notas = run_query("""
-                        SELECT m.nombre, c.nota, c.fecha 
-                        FROM calificaciones c
-                        JOIN materias m ON c.materia_id = m.id
-                        WHERE c.alumno_id = ?
-                        ORDER BY c.fecha DESC
-                    """, (id_alumno_calif,), return_data=True)
+                    df_notas = df_calif.loc[~es_asignada, ['Materia', 'Nota', 'Fecha']].reset_index(drop=True)
                     
-                    df_notas = pd.DataFrame(notas, columns=['Materia', 'Nota', 'Fecha'])
                     st.dataframe(df_notas, use_container_width=True)
                     
                     if not df_notas.empty:
-                        promedio = df_notas['Nota'].mean()
+                        promedio = df_calif.at[0, 'Promedio']
                         st.metric("Promedio General", f"{promedio:.2f}")
 
                 else:
@@ -308,7 +498,9 @@ def main():
                 alumno_reporte = st.selectbox("Selecciona Alumno para Reporte:", list(dict_alumnos.keys()))
                 id_alumno_reporte = dict_alumnos[alumno_reporte]
                 
-                df_all_notes, df_summary = generate_report_data(id_alumno_reporte)
+                # El reporte solo se recalcula cuando cambian las notas del alumno
+                fingerprint = report_fingerprint(id_alumno_reporte)
+                df_all_notes, df_summary = generate_report_data(id_alumno_reporte, fingerprint)
                 
                 if not df_all_notes.empty:
                     st.markdown("#### Resumen de Promedios por Materia")
@@ -319,25 +511,18 @@ def main():
                     
                     # --- FUNCIONALIDAD DE EXPORTACIÓN ---
                     
-                    # Convertir el DataFrame de Resumen a CSV
-                    csv_summary = df_summary.to_csv(index=False).encode('utf-8')
-                    
+                    # Resumen en CSV y boletín completo en Excel (en caché mientras no cambien las notas)
                     st.download_button(
                         label="Descargar Promedios (CSV)",
-                        data=csv_summary,
+                        data=build_csv(id_alumno_reporte, fingerprint),
                         file_name=f'Reporte_Promedios_{alumno_reporte.replace(" ", "_")}.csv',
                         mime='text/csv',
                     )
 
-                    # Convertir el DataFrame Completo a Excel (mejor para reportes complejos)
-                    buffer = io.BytesIO()
-                    with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-                        df_summary.to_excel(writer, sheet_name='Resumen', index=False)
-                        df_all_notes.to_excel(writer, sheet_name='Historial Completo', index=False)
-                    
+                    # El Excel es lo más costoso: se genera recién al hacer clic en el botón
                     st.download_button(
                         label="Descargar Boletín Completo (Excel)",
-                        data=buffer.getvalue(),
+                        data=partial(build_xlsx, id_alumno_reporte, fingerprint),
                         file_name=f'Boletin_Completo_{alumno_reporte.replace(" ", "_")}.xlsx',
                         mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
                     )